@@ -1,12 +1,26 @@
 #!/usr/bin/python3
 
 # imports
+import argparse
 import sqlalchemy
+from psycopg2.extras import execute_values
 import os
+import collections
+import itertools
+import multiprocessing
 import datetime
 import zipfile
 import io
-import json
+
+# orjson is several times faster than the stdlib json module at parsing tweets;
+# all three modules accept bytes, so the input files never need to be decoded in python
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
 
 ################################################################################
 # helper functions
@@ -34,51 +48,218 @@ def remove_nulls(s):
     '''
     if s is None:
         return None
+    # nearly every string has no null characters;
+    # replace would return the same string in that case too,
+    # but the membership test scans it more cheaply and skips the method call overhead
+    elif '\x00' not in s:
+        return s
     else:
         return s.replace('\x00','')
 
 
-def get_id_urls(url, connection):
+# an LRU cache mapping urls to their id_urls;
+# many tweets share the same urls (especially retweets and media),
+# so the cache lets get_id_urls skip the database for most urls
+_url_cache = collections.OrderedDict()
+_URL_CACHE_SIZE = 200000
+
+# the statements used by get_id_urls and insert_tweet run on a raw psycopg2 cursor
+# (skipping sqlalchemy's per-statement overhead), so they use psycopg2's %(name)s placeholders
+#
+# get_id_urls needs only one round-trip:
+# when no conflict occurs, the insert returns the new id_urls;
+# when a conflict occurs, the insert returns nothing and the id_urls comes from the select instead
+# (the select cannot see the row inserted by the CTE, so exactly one row is returned either way)
+_SQL_GET_ID_URLS = '''
+with ins as (
+    insert into urls
+        (url)
+        values
+        (%(url)s)
+    on conflict (url) do nothing
+    returning id_urls
+)
+select id_urls from ins
+union all
+select id_urls from urls where url=%(url)s
+limit 1
+;
+'''
+
+
+def get_id_urls(url, cursor):
     '''
     Given a url, return the corresponding id in the urls table.
     If no row exists for the url, then one is inserted automatically.
+    Recently used urls are cached so that repeated urls do not require a round-trip to the db.
 
     NOTE:
     This function cannot be tested with standard python testing tools because it interacts with the db.
     '''
-    sql = sqlalchemy.sql.text('''
-    insert into urls 
-        (url)
-        values
-        (:url)
-    on conflict do nothing
-    returning id_urls
-    ;
-    ''')
-    res = connection.execute(sql,{'url':url}).first()
-
-    # when no conflict occurs, then the query above inserts a new row in the url table and returns id_urls in res[0];
-    # when a conflict occurs, then the query above does not insert or return anything;
-    # we need to run a select statement to put the already existing id_urls into ees[0]
-    if res is None:
-        sql = sqlalchemy.sql.text('''
-        select id_urls 
-        from urls
-        where
-            url=:url
-        ''')
-        res = connection.execute(sql,{'url':url}).first()
-
-    id_urls = res[0]
+    id_urls = _url_cache.get(url)
+    if id_urls is not None:
+        _url_cache.move_to_end(url)
+        return id_urls
+
+    cursor.execute(_SQL_GET_ID_URLS,{'url':url})
+    id_urls = cursor.fetchone()[0]
+    _url_cache[url] = id_urls
+    if len(_url_cache) > _URL_CACHE_SIZE:
+        _url_cache.popitem(last=False)
     return id_urls
 
 
-def insert_tweet(connection,tweet):
+def get_geo(tweet):
+    '''
+    Return the location of the tweet in WKT format (suitable for ST_GeomFromText),
+    or None if the tweet has no location.
+    Tweets with exact coordinates are stored as a POINT;
+    otherwise the bounding box of the tweet's place is stored as a MULTIPOLYGON.
+
+    >>> get_geo({'geo': {'coordinates': [1.5, 2]}})
+    'POINT(1.5 2)'
+    >>> get_geo({'geo': None, 'place': {'bounding_box': {'coordinates': [[[0, 0], [0, 1], [1, 1]]]}}})
+    'MULTIPOLYGON(((0 0,0 1,1 1,0 0)))'
+    >>> get_geo({'geo': None, 'place': None}) is None
+    True
+    '''
+    if tweet.get('geo') is not None:
+        coordinates = tweet['geo']['coordinates']
+        return f'POINT({coordinates[0]} {coordinates[1]})'
+
+    # each polygon is closed by repeating its first point;
+    # the strings are built with join because repeated += is quadratic in the number of points
+    try:
+        polys = tweet['place']['bounding_box']['coordinates']
+    except (KeyError, TypeError):
+        return None
+    wkt_polys = []
+    for poly in polys:
+        points = [ f'{point[0]} {point[1]}' for point in poly ]
+        points.append(f'{poly[0][0]} {poly[0][1]}')
+        wkt_polys.append('(' + ','.join(points) + ')')
+    return 'MULTIPOLYGON((' + ','.join(wkt_polys) + '))'
+
+
+def get_place(tweet):
+    '''
+    Return the (place_name, country_code, state_code) triple for the tweet.
+    Any of the values may be None;
+    state_code is only computed for tweets in the US.
+
+    >>> get_place({'place': {'full_name': 'Claremont, CA', 'country_code': 'US'}})
+    ('Claremont, CA', 'us', 'ca')
+    >>> get_place({'place': {'full_name': 'California, USA', 'country_code': 'US'}})
+    ('California, USA', 'us', None)
+    >>> get_place({'place': {'full_name': 'DC', 'country_code': 'US'}})
+    ('DC', 'us', 'dc')
+    >>> get_place({'place': None})
+    (None, None, None)
+    '''
+    place = tweet['place']
+    if place is None:
+        return None, None, None
+
+    place_name = place['full_name']
+    country_code = place['country_code'].lower()
+
+    if country_code == 'us':
+        # the state is the text after the last comma (or the whole name if there is no comma);
+        # rfind avoids building the list that split would return
+        state_code = place_name[place_name.rfind(',')+1:].strip().lower()
+        if len(state_code)>2:
+            state_code = None
+    else:
+        state_code = None
+
+    return place_name, country_code, state_code
+
+
+def get_text(tweet):
+    '''
+    Return the full text of the tweet;
+    tweets longer than 140 characters store it in the extended_tweet object.
+
+    >>> get_text({'text': 'short', 'extended_tweet': {'full_text': 'long'}})
+    'long'
+    >>> get_text({'text': 'short'})
+    'short'
+    '''
+    try:
+        return tweet['extended_tweet']['full_text']
+    except KeyError:
+        return tweet['text']
+
+
+def get_entities(tweet):
+    '''
+    Return the entities object (urls, user_mentions, hashtags, symbols) of the tweet,
+    preferring the complete one in the extended_tweet object when it exists.
+
+    >>> get_entities({'entities': {'urls': []}, 'extended_tweet': {'entities': {'urls': [1]}}})
+    {'urls': [1]}
+    >>> get_entities({'entities': {'urls': []}})
+    {'urls': []}
+    '''
+    try:
+        return tweet['extended_tweet']['entities']
+    except KeyError:
+        return tweet['entities']
+
+
+def get_media(tweet):
+    '''
+    Return the list of media objects attached to the tweet (possibly empty).
+
+    >>> get_media({'extended_entities': {'media': [1]}})
+    [1]
+    >>> get_media({})
+    []
+    '''
+    try:
+        return tweet['extended_tweet']['extended_entities']['media']
+    except KeyError:
+        try:
+            return tweet['extended_entities']['media']
+        except KeyError:
+            return []
+
+
+_SQL_INSERT_USER = '''
+INSERT INTO users
+(id_users,created_at,updated_at,screen_name,name,location,id_urls,description,protected,verified,friends_count,listed_count,favourites_count,statuses_count,withheld_in_countries)
+VALUES
+(%(id_users)s,%(created_at)s,%(updated_at)s,%(screen_name)s,%(name)s,%(location)s,%(id_urls)s,%(description)s,%(protected)s,%(verified)s,%(friends_count)s,%(listed_count)s,%(favourites_count)s,%(statuses_count)s,%(withheld_in_countries)s)
+ON CONFLICT (id_users) DO NOTHING
+'''
+
+_SQL_INSERT_UNHYDRATED_USER = '''
+insert into users
+    (id_users)
+    values
+    (%(in_reply_to_user_id)s)
+on conflict do nothing
+'''
+
+_SQL_INSERT_TWEET = '''
+INSERT INTO tweets
+(id_tweets,id_users,created_at,in_reply_to_status_id,in_reply_to_user_id,quoted_status_id,geo,retweet_count,quote_count,favorite_count,withheld_copyright,withheld_in_countries,place_name,country_code,state_code,lang,text,source)
+VALUES
+(%(id_tweets)s,%(id_users)s,%(created_at)s,%(in_reply_to_status_id)s,%(in_reply_to_user_id)s,%(quoted_status_id)s,ST_GeomFromText(%(geo)s),%(retweet_count)s,%(quote_count)s,%(favorite_count)s,%(withheld_copyright)s,%(withheld_in_countries)s,%(place_name)s,%(country_code)s,%(state_code)s,%(lang)s,%(text)s,%(source)s)
+ON CONFLICT DO NOTHING
+RETURNING id_tweets;
+'''
+
+
+def insert_tweet(cursor,tweet):
     '''
     Insert the tweet into the database.
+    The caller is responsible for the transaction (see load_batch);
+    running many tweets in a single transaction avoids a commit per tweet,
+    and ensures that a tweet does not get "partially" loaded.
 
     Args:
-        connection: a sqlalchemy connection to the postgresql db
+        cursor: a raw psycopg2 cursor on the postgresql db, shared by the whole batch
         tweet: a dictionary representing the json tweet object
 
     NOTE:
@@ -89,316 +270,671 @@ def insert_tweet(connection,tweet):
     You'll need to add appropriate SQL insert statements to get it to work.
     '''
 
-    # skip tweet if it's already inserted
-    sql=sqlalchemy.sql.text('''
-    SELECT id_tweets 
-    FROM tweets
-    WHERE id_tweets = :id_tweets
-    ''')
-    res = connection.execute(sql,{
-        'id_tweets':str(tweet['id']),
+    # the nested objects are looked up once rather than once per field
+    user = tweet['user']
+    entities = get_entities(tweet)
+
+    # NOTE:
+    # there is no separate check for whether the tweet is already inserted;
+    # instead, the insert into the tweets table below reports whether it conflicted
+
+    ########################################
+    # insert into the users table
+    ########################################
+    if user['url'] is None:
+        user_id_urls = None
+    else:
+        user_id_urls = get_id_urls(user['url'], cursor)
+
+    # create/update the user
+    cursor.execute(_SQL_INSERT_USER,{
+        'id_users':user['id'],
+        'created_at':user['created_at'],
+        'updated_at':tweet['created_at'],
+        'screen_name':remove_nulls(user['screen_name']),
+        'name':remove_nulls(user['name']),
+        'location':remove_nulls(user['location']),
+        'id_urls':user_id_urls,
+        'description':remove_nulls(user['description']),
+        'protected':user['protected'],
+        'verified':user['verified'],
+        'friends_count':user['friends_count'],
+        'listed_count':user['listed_count'],
+        'favourites_count':user['favourites_count'],
+        'statuses_count':user['statuses_count'],
+        'withheld_in_countries':user.get('withheld_in_countries', None),})
+    ########################################
+    # insert into the tweets table
+    ########################################
+
+    geo = get_geo(tweet)
+
+    text = get_text(tweet)
+
+    place_name, country_code, state_code = get_place(tweet)
+
+    # NOTE:
+    # The tweets table has the following foreign key:
+    # > FOREIGN KEY (in_reply_to_user_id) REFERENCES users(id_users)
+    #
+    # This means that every "in_reply_to_user_id" field must reference a valid entry in the users table.
+    # If the id is not in the users table, then you'll need to add it in an "unhydrated" form;
+    # the ON CONFLICT clause makes this a no-op when the user already exists.
+    if tweet.get('in_reply_to_user_id',None) is not None:
+        cursor.execute(_SQL_INSERT_UNHYDRATED_USER, {
+            'in_reply_to_user_id':tweet['in_reply_to_user_id']
+            })
+    # insert the tweet
+    cursor.execute(_SQL_INSERT_TWEET,{
+        'id_tweets':tweet['id'],
+        'id_users':user['id'],
+        'created_at':tweet['created_at'],
+        'in_reply_to_status_id':tweet.get('in_reply_to_status_id',None),
+        'in_reply_to_user_id':tweet.get('in_reply_to_user_id',None),
+        'quoted_status_id':tweet.get('quoted_status_id',None),
+        'geo':geo,
+        'retweet_count':tweet.get('retweet_count',None),
+        'quote_count':tweet.get('quote_count',None),
+        'favorite_count':tweet.get('favorite_count',None),
+        'withheld_copyright':tweet.get('withheld_copyright',None),
+        'withheld_in_countries':tweet.get('withheld_in_countries',None),
+        'place_name':place_name,
+        'country_code':country_code,
+        'state_code':state_code,
+        'lang':tweet.get('lang'),
+        'text':remove_nulls(text),
+        'source':remove_nulls(tweet.get('source',None)),
         })
-    if res.first() is not None:
+
+    # the tweet was already inserted, and so are its urls/mentions/tags/media;
+    # the users/urls rows above are still valid, so they are left in the transaction
+    if cursor.fetchone() is None:
         return
 
-    # insert tweet within a transaction;
-    # this ensures that a tweet does not get "partially" loaded
-    with connection.begin() as trans:
+    # the child rows below are inserted with execute_values,
+    # which sends all of the rows for a table in a single statement
+
+    ########################################
+    # insert into the tweet_urls table
+    ########################################
+
+    urls = entities['urls']
+
+    execute_values(cursor, '''
+        INSERT INTO tweet_urls
+        (id_tweets, id_urls)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        ''', [
+        (tweet['id'], get_id_urls(url['expanded_url'], cursor))
+        for url in urls
+        ])
+
+    ########################################
+    # insert into the tweet_mentions table
+    ########################################
+
+    mentions = entities['user_mentions']
+
+    # insert into users table;
+    # note that we already have done an insert into the users table above for the user who sent a tweet;
+    # that insert had lots of information inside of it (i.e. the user row was "hydrated");
+    # when we only have a mention of a user, however, we do not have all the information to store in the row;
+    # therefore, we must store the user info "unhydrated"
+    execute_values(cursor, '''
+        INSERT INTO users
+        (id_users, screen_name, name)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        ''', [
+        (mention['id'], mention['screen_name'], mention['name'])
+        for mention in mentions
+        ])
+
+    # insert into tweet_mentions
+    execute_values(cursor, '''
+        INSERT INTO tweet_mentions
+        (id_tweets,id_users)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        ''', [
+        (tweet['id'], mention['id'])
+        for mention in mentions
+        ])
+
+    ########################################
+    # insert into the tweet_tags table
+    ########################################
+
+    hashtags = entities['hashtags']
+    cashtags = entities['symbols']
+
+    # chain avoids building (and then concatenating) a separate list for each kind of tag
+    tags = itertools.chain(
+        ( '#'+hashtag['text'] for hashtag in hashtags ),
+        ( '$'+cashtag['text'] for cashtag in cashtags ),
+        )
+
+    execute_values(cursor, '''
+        INSERT INTO tweet_tags
+        (id_tweets, tag)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        ''', [
+        (tweet['id'], remove_nulls(tag))
+        for tag in tags
+        ])
+
+    ########################################
+    # insert into the tweet_media table
+    ########################################
+
+    media = get_media(tweet)
+
+    execute_values(cursor, '''
+        INSERT INTO tweet_media
+        (id_tweets, id_urls, type)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        ''', [
+        (tweet['id'], get_id_urls(medium['media_url'], cursor), medium['type'])
+        for medium in media
+        ])
 
-        ########################################
-        # insert into the users table
-        ########################################
-        if tweet['user']['url'] is None:
-            user_id_urls = None
-        else:
-            user_id_urls = get_id_urls(tweet['user']['url'], connection)
+################################################################################
+# bulk loading with COPY
+################################################################################
 
-        # create/update the user
-        sql = sqlalchemy.sql.text('''
-        INSERT INTO users
-        (id_users,created_at,updated_at,screen_name,name,location,id_urls,description,protected,verified,friends_count,listed_count,favourites_count,statuses_count,withheld_in_countries)
-        VALUES
-        (:id_users,:created_at,:updated_at,:screen_name,:name,:location,:id_urls,:description,:protected,:verified,:friends_count,:listed_count,:favourites_count,:statuses_count,:withheld_in_countries)
-        ON CONFLICT (id_users) DO NOTHING
-                ''')
-        res = connection.execute(sql,{
-            'id_users':tweet['user']['id'],
-            'created_at':tweet['user']['created_at'],
-            'updated_at':tweet['created_at'],
-            'screen_name':remove_nulls(tweet['user']['screen_name']),
-            'name':remove_nulls(tweet['user']['name']),
-            'location':remove_nulls(tweet['user']['location']),
-            'id_urls':user_id_urls,
-            'description':remove_nulls(tweet['user']['description']),
-            'protected':tweet['user']['protected'],
-            'verified':tweet['user']['verified'],
-            'friends_count':tweet['user']['friends_count'],
-            'listed_count':tweet['user']['listed_count'],
-            'favourites_count':tweet['user']['favourites_count'],
-            'statuses_count':tweet['user']['statuses_count'],
-            'withheld_in_countries':tweet['user'].get('withheld_in_countries', None),})
-        ########################################
-        # insert into the tweets table
-        ########################################
+# The staging tables (see services/pg_normalized/schema.sql) mirror the real tables,
+# except that urls are stored as text rather than as id_urls and geo is stored as WKT text.
+# Rows are COPYed into the staging tables in bulk,
+# and then moved into the real tables with INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+STAGING_COLUMNS = {
+    'stg_urls': ('url',),
+    'stg_users': ('id_users','created_at','updated_at','screen_name','name','location','url','description','protected','verified','friends_count','listed_count','favourites_count','statuses_count','withheld_in_countries'),
+    'stg_tweets': ('id_tweets','id_users','created_at','in_reply_to_status_id','in_reply_to_user_id','quoted_status_id','geo','retweet_count','quote_count','favorite_count','withheld_copyright','withheld_in_countries','place_name','country_code','state_code','lang','text','source'),
+    'stg_tweet_urls': ('id_tweets','url'),
+    'stg_tweet_mentions': ('id_tweets','id_users'),
+    'stg_tweet_tags': ('id_tweets','tag'),
+    'stg_tweet_media': ('id_tweets','url','type'),
+    }
+
+# backslash escapes used by COPY's text format
+_COPY_ESCAPES = str.maketrans({'\\':'\\\\', '\t':'\\t', '\n':'\\n', '\r':'\\r'})
+
+
+def copy_format(value):
+    r'''
+    Format a python value as a single field in postgres's COPY text format.
+    None becomes \N, booleans and lists use postgres's literal syntax,
+    and backslashes, tabs, and newlines are escaped so that they cannot break the row.
+    Null characters are removed for the same reason as in remove_nulls.
+
+    >>> print(copy_format(None))
+    \N
+    >>> copy_format(True)
+    't'
+    >>> copy_format(['US','DE'])
+    '{"US","DE"}'
+    >>> print(copy_format('a\tb\\c\x00'))
+    a\tb\\c
+    '''
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, list):
+        value = '{' + ','.join('"' + str(v).replace('\\','\\\\').replace('"','\\"') + '"' for v in value) + '}'
+    return remove_nulls(str(value)).translate(_COPY_ESCAPES)
+
+
+def new_buffers():
+    '''
+    Return a dictionary mapping each staging table to an empty buffer of COPY rows.
+    '''
+    return { table:io.StringIO() for table in STAGING_COLUMNS }
 
-        try:
-            geo_coords = tweet['geo']['coordinates']
-            geo_coords = str(tweet['geo']['coordinates'][0]) + ' ' + str(tweet['geo']['coordinates'][1])
-            geo_str = 'POINT'
-        except TypeError:
-            try:
-                geo_coords = '('
-                for i,poly in enumerate(tweet['place']['bounding_box']['coordinates']):
-                    if i>0:
-                        geo_coords+=','
-                    geo_coords+='('
-                    for j,point in enumerate(poly):
-                        geo_coords+= str(point[0]) + ' ' + str(point[1]) + ','
-                    geo_coords+= str(poly[0][0]) + ' ' + str(poly[0][1])
-                    geo_coords+=')'
-                geo_coords+=')'
-                geo_str = 'MULTIPOLYGON'
-            except KeyError:
-                if tweet['user']['geo_enabled']:
-                    geo_str = None
-                    geo_coords = None
 
+def write_row(buffers, table, *values):
+    '''
+    Append a row to the buffer for the given staging table.
+    '''
+    buffers[table].write('\t'.join(map(copy_format, values)) + '\n')
+
+
+def buffer_tweet(buffers,tweet):
+    r'''
+    Append the rows for the tweet to the staging table buffers.
+    This is the bulk equivalent of insert_tweet;
+    nothing is sent to the database until flush_buffers is called.
+
+    >>> buffers = new_buffers()
+    >>> buffer_tweet(buffers, {
+    ...     'id': 1, 'created_at': 'Wed Oct 10 20:19:24 +0000 2018', 'text': 'hi #pg', 'geo': None, 'place': None,
+    ...     'user': {'id': 2, 'created_at': 'Tue Oct 09 20:19:24 +0000 2018', 'screen_name': 's', 'name': 'n',
+    ...              'location': None, 'url': None, 'description': None, 'protected': False, 'verified': False,
+    ...              'friends_count': 0, 'listed_count': 0, 'favourites_count': 0, 'statuses_count': 1},
+    ...     'entities': {'urls': [], 'user_mentions': [], 'hashtags': [{'text': 'pg'}], 'symbols': []},
+    ...     })
+    >>> buffers['stg_tweet_tags'].getvalue()
+    '1\t#pg\n'
+    '''
+    # the nested objects are looked up once rather than once per field
+    user = tweet['user']
+    entities = get_entities(tweet)
+
+    ########################################
+    # users
+    ########################################
+    if user['url'] is not None:
+        write_row(buffers, 'stg_urls', user['url'])
+
+    write_row(buffers, 'stg_users',
+        user['id'],
+        user['created_at'],
+        tweet['created_at'],
+        user['screen_name'],
+        user['name'],
+        user['location'],
+        user['url'],
+        user['description'],
+        user['protected'],
+        user['verified'],
+        user['friends_count'],
+        user['listed_count'],
+        user['favourites_count'],
+        user['statuses_count'],
+        user.get('withheld_in_countries', None),
+        )
+
+    # the tweets table has a foreign key on in_reply_to_user_id,
+    # so we need to add an unhydrated user
+    if tweet.get('in_reply_to_user_id',None) is not None:
+        write_row(buffers, 'stg_users', tweet['in_reply_to_user_id'], *[None]*14)
+
+    ########################################
+    # tweets
+    ########################################
+    text = get_text(tweet)
+
+    place_name, country_code, state_code = get_place(tweet)
+
+    write_row(buffers, 'stg_tweets',
+        tweet['id'],
+        user['id'],
+        tweet['created_at'],
+        tweet.get('in_reply_to_status_id',None),
+        tweet.get('in_reply_to_user_id',None),
+        tweet.get('quoted_status_id',None),
+        get_geo(tweet),
+        tweet.get('retweet_count',None),
+        tweet.get('quote_count',None),
+        tweet.get('favorite_count',None),
+        tweet.get('withheld_copyright',None),
+        tweet.get('withheld_in_countries',None),
+        place_name,
+        country_code,
+        state_code,
+        tweet.get('lang'),
+        text,
+        tweet.get('source',None),
+        )
+
+    ########################################
+    # tweet_urls
+    ########################################
+    for url in entities['urls']:
+        if url['expanded_url'] is not None:
+            write_row(buffers, 'stg_urls', url['expanded_url'])
+            write_row(buffers, 'stg_tweet_urls', tweet['id'], url['expanded_url'])
+
+    ########################################
+    # tweet_mentions
+    ########################################
+    for mention in entities['user_mentions']:
+        write_row(buffers, 'stg_users', mention['id'], None, None, mention['screen_name'], mention['name'], *[None]*10)
+        write_row(buffers, 'stg_tweet_mentions', tweet['id'], mention['id'])
+
+    ########################################
+    # tweet_tags
+    ########################################
+    tags = itertools.chain(
+        ( '#'+hashtag['text'] for hashtag in entities['hashtags'] ),
+        ( '$'+cashtag['text'] for cashtag in entities['symbols'] ),
+        )
+
+    for tag in tags:
+        write_row(buffers, 'stg_tweet_tags', tweet['id'], tag)
+
+    ########################################
+    # tweet_media
+    ########################################
+    media = get_media(tweet)
+
+    for medium in media:
+        write_row(buffers, 'stg_urls', medium['media_url'])
+        write_row(buffers, 'stg_tweet_media', tweet['id'], medium['media_url'], medium['type'])
+
+
+# the statements that move the staging tables into the real tables;
+# the order of these statements matters because of the foreign keys
+_SQL_MERGE_STAGING = [
+    sqlalchemy.sql.text('''
+    INSERT INTO urls
+    (url)
+    SELECT DISTINCT url
+    FROM stg_urls
+    ON CONFLICT DO NOTHING
+    '''),
+    # when a user appears several times in a batch, prefer the hydrated rows,
+    # then the most recently updated profile, then rows (i.e. mentions) that know the screen_name;
+    # the tie-breakers make the chosen row deterministic
+    sqlalchemy.sql.text('''
+    INSERT INTO users
+    (id_users,created_at,updated_at,screen_name,name,location,id_urls,description,protected,verified,friends_count,listed_count,favourites_count,statuses_count,withheld_in_countries)
+    SELECT DISTINCT ON (stg_users.id_users)
+        stg_users.id_users,created_at,updated_at,screen_name,name,location,urls.id_urls,description,protected,verified,friends_count,listed_count,favourites_count,statuses_count,withheld_in_countries
+    FROM stg_users
+    LEFT JOIN urls ON urls.url = stg_users.url
+    ORDER BY stg_users.id_users, stg_users.created_at IS NULL, stg_users.updated_at DESC, stg_users.screen_name IS NULL
+    ON CONFLICT (id_users) DO NOTHING
+    '''),
+    sqlalchemy.sql.text('''
+    INSERT INTO tweets
+    (id_tweets,id_users,created_at,in_reply_to_status_id,in_reply_to_user_id,quoted_status_id,geo,retweet_count,quote_count,favorite_count,withheld_copyright,withheld_in_countries,place_name,country_code,state_code,lang,text,source)
+    SELECT DISTINCT ON (id_tweets)
+        id_tweets,id_users,created_at,in_reply_to_status_id,in_reply_to_user_id,quoted_status_id,ST_GeomFromText(geo),retweet_count,quote_count,favorite_count,withheld_copyright,withheld_in_countries,place_name,country_code,state_code,lang,text,source
+    FROM stg_tweets
+    ORDER BY id_tweets
+    ON CONFLICT DO NOTHING
+    '''),
+    sqlalchemy.sql.text('''
+    INSERT INTO tweet_urls
+    (id_tweets,id_urls)
+    SELECT id_tweets, urls.id_urls
+    FROM stg_tweet_urls
+    JOIN urls ON urls.url = stg_tweet_urls.url
+    ON CONFLICT DO NOTHING
+    '''),
+    sqlalchemy.sql.text('''
+    INSERT INTO tweet_mentions
+    (id_tweets,id_users)
+    SELECT id_tweets, id_users
+    FROM stg_tweet_mentions
+    ON CONFLICT DO NOTHING
+    '''),
+    sqlalchemy.sql.text('''
+    INSERT INTO tweet_tags
+    (id_tweets,tag)
+    SELECT id_tweets, tag
+    FROM stg_tweet_tags
+    ON CONFLICT DO NOTHING
+    '''),
+    sqlalchemy.sql.text('''
+    INSERT INTO tweet_media
+    (id_tweets,id_urls,type)
+    SELECT id_tweets, urls.id_urls, type
+    FROM stg_tweet_media
+    JOIN urls ON urls.url = stg_tweet_media.url
+    ON CONFLICT DO NOTHING
+    '''),
+    sqlalchemy.sql.text(
+        'TRUNCATE ' + ','.join(STAGING_COLUMNS)
+        ),
+    ]
+
+
+def flush_buffers(connection,buffers):
+    '''
+    COPY the buffered rows into the staging tables,
+    move them into the real tables,
+    and then empty both the staging tables and the buffers.
+    Everything happens within a single transaction,
+    so a batch is either loaded completely or not at all.
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    with connection.begin():
+
+        # COPY needs the raw psycopg2 cursor; it shares the transaction with the sqlalchemy connection
+        cursor = connection.connection.cursor()
+        for table,columns in STAGING_COLUMNS.items():
+            buffers[table].seek(0)
+            cursor.copy_expert(f'COPY {table} ({",".join(columns)}) FROM STDIN', buffers[table])
+
+        for sql in _SQL_MERGE_STAGING:
+            connection.execute(sql)
+
+    for buf in buffers.values():
+        buf.seek(0)
+        buf.truncate()
+
+
+_SQL_SELECT_TWEETS = sqlalchemy.sql.text('''
+SELECT id_tweets
+FROM tweets
+WHERE id_tweets = ANY(:ids)
+''')
+
+
+def load_batch(connection,tweets,method):
+    '''
+    Load a batch of tweets, skipping the tweets that are already in the database.
+    The existing tweets are found with a single query for the whole batch,
+    so that re-loading a file does not cost a round-trip per tweet.
+
+    Args:
+        connection: a sqlalchemy connection to the postgresql db
+        tweets: a list of dictionaries representing the json tweet objects
+        method: either 'copy' (use buffer_tweet/flush_buffers) or 'insert' (use insert_tweet)
+
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    res = connection.execute(_SQL_SELECT_TWEETS,{
+        'ids':[ tweet['id'] for tweet in tweets ],
+        })
+    existing = { row[0] for row in res }
+
+    if method == 'copy':
+        buffers = new_buffers()
+        for tweet in tweets:
+            if tweet['id'] not in existing:
+                buffer_tweet(buffers,tweet)
+        flush_buffers(connection,buffers)
+    else:
+        # all of the tweets in the batch are inserted in a single transaction,
+        # so there is one commit per batch rather than one per tweet
+        #
+        # the statements run on a single raw psycopg2 cursor rather than through sqlalchemy;
+        # the cursor shares the transaction with the sqlalchemy connection
         try:
-            text = tweet['extended_tweet']['full_text']
+            with connection.begin():
+                with connection.connection.cursor() as cursor:
+                    for tweet in tweets:
+                        if tweet['id'] not in existing:
+                            insert_tweet(cursor,tweet)
         except:
-            text = tweet['text']
+            # the ids of urls inserted by the rolled back transaction are no longer valid
+            _url_cache.clear()
+            raise
+
+
+# the indexes on the tweet tables, excluding every unique index and every index that backs a constraint;
+# ON CONFLICT infers its arbiter from any unique index (not just those backing a constraint),
+# so dropping one would make ON CONFLICT DO NOTHING silently insert duplicates or fail outright
+_SQL_SELECT_INDEXES = '''
+SELECT format('%I.%I', pg_indexes.schemaname, pg_indexes.indexname), pg_indexes.indexdef
+FROM pg_indexes
+JOIN pg_index ON pg_index.indexrelid = format('%I.%I', pg_indexes.schemaname, pg_indexes.indexname)::regclass
+WHERE pg_indexes.schemaname = current_schema()
+  AND pg_indexes.tablename IN ('urls','users','tweets','tweet_urls','tweet_mentions','tweet_tags','tweet_media')
+  AND NOT pg_index.indisunique
+  AND NOT EXISTS (
+    SELECT 1
+    FROM pg_constraint
+    WHERE pg_constraint.conindid = pg_index.indexrelid
+    )
+'''
+
+
+def drop_indexes(connection):
+    '''
+    Drop the indexes on the tweet tables, and return their definitions so that create_indexes can rebuild them.
+    Postgres must update every index for every inserted row,
+    so loading without the indexes and then building them once at the end is much faster.
 
-        try:
-            country_code = tweet['place']['country_code'].lower()
-        except TypeError:
-            country_code = None
-
-        if country_code == 'us':
-            state_code = tweet['place']['full_name'].split(',')[-1].strip().lower()
-            if len(state_code)>2:
-                state_code = None
-        else:
-            state_code = None
+    NOTE:
+    This function cannot be tested with standard python testing tools because it interacts with the db.
+    '''
+    with connection.begin():
+        cursor = connection.connection.cursor()
+        cursor.execute(_SQL_SELECT_INDEXES)
+        indexes = cursor.fetchall()
+        for name,indexdef in indexes:
+            print(datetime.datetime.now(),'drop index',name)
+            cursor.execute(f'DROP INDEX {name}')
+    return [ indexdef for name,indexdef in indexes ]
 
-        try:
-            place_name = tweet['place']['full_name']
-        except TypeError:
-            place_name = None
 
-        # NOTE:
-        # The tweets table has the following foreign key:
-        # > FOREIGN KEY (in_reply_to_user_id) REFERENCES users(id_users)
-        #
-        # This means that every "in_reply_to_user_id" field must reference a valid entry in the users table.
-        # If the id is not in the users table, then you'll need to add it in an "unhydrated" form.
-        if tweet.get('in_reply_to_user_id',None) is not None:
-            sql=sqlalchemy.sql.text('''
-            SELECT id_users
-            FROM users
-            WHERE id_users = :in_reply_to_user_id
-            ''')
-            
-            res = connection.execute(sql,{
-                'in_reply_to_user_id':tweet['in_reply_to_user_id']
-            })
-       
-            if res.first() is None:
-                sql = sqlalchemy.sql.text('''
-                insert into users
-                    (id_users)
-                    values
-                    (:in_reply_to_user_id)
-                ''')
-                
-                res = connection.execute(sql, {
-                    'in_reply_to_user_id':tweet['in_reply_to_user_id']
-                    })
-        # insert the tweet
-        sql=sqlalchemy.sql.text(f'''
-            INSERT INTO tweets
-            (id_tweets,id_users,created_at,in_reply_to_status_id,in_reply_to_user_id,quoted_status_id,geo,retweet_count,quote_count,favorite_count,withheld_copyright,withheld_in_countries,place_name,country_code,state_code,lang,text,source)
-            VALUES
-            (:id_tweets,:id_users,:created_at,:in_reply_to_status_id,:in_reply_to_user_id,:quoted_status_id,ST_GeomFromText(:geo_str || '(' || :geo_coords || ')'),:retweet_count,:quote_count,:favorite_count,:withheld_copyright,:withheld_in_countries,:place_name,:country_code,:state_code,:lang,:text,:source)
-        ON CONFLICT DO NOTHING;
-            ''')
-        res = connection.execute(sql,{
-            'id_tweets':tweet['id'],
-            'id_users':tweet['user']['id'],
-            'created_at':tweet['created_at'],
-            'in_reply_to_status_id':tweet.get('in_reply_to_status_id',None),
-            'in_reply_to_user_id':tweet.get('in_reply_to_user_id',None),
-            'quoted_status_id':tweet.get('quoted_status_id',None),
-            'geo_coords':geo_coords,
-            'geo_str':geo_str,
-            'retweet_count':tweet.get('retweet_count',None),
-            'quote_count':tweet.get('quote_count',None),
-            'favorite_count':tweet.get('favorite_count',None),
-            'withheld_copyright':tweet.get('withheld_copyright',None),
-            'withheld_in_countries':tweet.get('withheld_in_countries',None),
-            'place_name':place_name,
-            'country_code':country_code,
-            'state_code':state_code,
-            'lang':tweet.get('lang'),
-            'text':remove_nulls(text),
-            'source':remove_nulls(tweet.get('source',None)),
-            })
+def create_indexes(connection,indexdefs):
+    '''
+    Rebuild the indexes dropped by drop_indexes.
 
-       ########################################
-        # insert into the tweet_urls table
-        ########################################
+    NOTE:
+    The indexes are built with plain CREATE INDEX rather than CREATE INDEX CONCURRENTLY;
+    a concurrent build scans the table twice and only helps when other sessions are writing to the table,
+    which is not the case at the end of a load.
+    '''
+    with connection.begin():
+        cursor = connection.connection.cursor()
+        for indexdef in indexdefs:
+            print(datetime.datetime.now(),indexdef)
+            cursor.execute(indexdef)
 
-        try:
-            urls = tweet['extended_tweet']['entities']['urls']
-        except KeyError:
-            urls = tweet['entities']['urls']
-
-        for url in urls:
-            id_urls = get_id_urls(url['expanded_url'], connection)
-
-            sql=sqlalchemy.sql.text('''
-            INSERT INTO tweet_urls
-            (id_tweets, id_urls)
-            VALUES
-            (:id_tweets, :id_urls)
-            ON CONFLICT DO NOTHING
-                ''')
-            res = connection.execute(sql,{
-                'id_tweets':tweet['id'],
-                'id_urls':id_urls
-                })
-        ########################################
-        # insert into the tweet_mentions table
-        ########################################
 
-        try:
-            mentions = tweet['extended_tweet']['entities']['user_mentions']
-        except KeyError:
-            mentions = tweet['entities']['user_mentions']
-
-        for mention in mentions:
-            # insert into users table;
-            # note that we already have done an insert into the users table above for the user who sent a tweet;
-            # that insert had lots of information inside of it (i.e. the user row was "hydrated");
-            # when we only have a mention of a user, however, we do not have all the information to store in the row;
-            # therefore, we must store the user info "unhydrated"
-            # HINT:
-            # use the ON CONFLICT DO NOTHING syntax
-            sql=sqlalchemy.sql.text('''
-                INSERT INTO users
-                (id_users, screen_name, name)
-                VALUES
-                (:id_users, :screen_name, :name)
-                ON CONFLICT DO NOTHING
-                ''')
-            res = connection.execute(sql, {
-                'id_users':mention['id'],
-                'screen_name':mention['screen_name'],
-                'name':mention['name']
-                })
-
-            # insert into tweet_mentions
-            sql=sqlalchemy.sql.text('''
-            INSERT INTO tweet_mentions
-            (id_tweets,id_users)
-            VALUES
-            (:id_tweets,:id_users)
-            ON CONFLICT DO NOTHING
-                ''')
-            
-            res = connection.execute(sql, {
-                'id_tweets':tweet['id'],
-                'id_users':mention['id']
-                })
-        ########################################
-        # insert into the tweet_tags table
-        ########################################
+def read_batches(inputs,batch_size,print_every):
+    '''
+    Yield the lines of the zipped input files as lists of (at most) batch_size raw json lines.
 
-        try:
-            hashtags = tweet['extended_tweet']['entities']['hashtags'] 
-            cashtags = tweet['extended_tweet']['entities']['symbols'] 
-        except KeyError:
-            hashtags = tweet['entities']['hashtags']
-            cashtags = tweet['entities']['symbols']
-
-        tags = [ '#'+hashtag['text'] for hashtag in hashtags ] + [ '$'+cashtag['text'] for cashtag in cashtags ]
-
-        for tag in tags:
-            sql=sqlalchemy.sql.text('''
-            INSERT INTO tweet_tags
-            (id_tweets, tag)
-            VALUES
-            (:id_tweets, :tag)
-            ON CONFLICT DO NOTHING
-            ''')
-            
-            res = connection.execute(sql,{
-                'id_tweets':tweet['id'],
-                'tag':remove_nulls(tag)
-                })
-        ########################################
-        # insert into the tweet_media table
-        ########################################
+    NOTE:
+    we reverse sort the filenames because this results in fewer updates to the users table,
+    which prevents excessive dead tuples and autovacuums
+    '''
+    lines = []
+    for filename in sorted(inputs, reverse=True):
+        with zipfile.ZipFile(filename, 'r') as archive: 
+            print(datetime.datetime.now(),filename)
+            for subfilename in sorted(archive.namelist(), reverse=True):
+                # the 1MB buffer means far fewer (small) reads through the zip decompressor
+                # than iterating over the zip member directly
+                with io.BufferedReader(archive.open(subfilename), buffer_size=1<<20) as f:
+                    for i,line in enumerate(f):
+                        lines.append(line)
+                        if len(lines) >= batch_size:
+                            yield lines
+                            lines = []
+
+                        # print message;
+                        # the tweets are parsed later (possibly in a worker process),
+                        # so the line is parsed here just for its id, which is cheap once every print_every lines
+                        if i%print_every==0:
+                            print(datetime.datetime.now(),filename,subfilename,'i=',i,'id=',json_loads(line)['id'])
+    if len(lines) > 0:
+        yield lines
+
+
+def buffer_lines(lines):
+    r'''
+    Parse a batch of raw json lines and return the staging table buffers for them.
+    With --processes > 1, this function runs in the worker processes;
+    the returned buffers are sent back to the main process, which passes them to flush_buffers.
+    Unlike load_batch, tweets already in the database are not skipped here
+    (the workers have no db connection), but the ON CONFLICT clauses make loading them a no-op.
+
+    >>> buffers = buffer_lines([b'{"id": 1, "created_at": "Wed Oct 10 20:19:24 +0000 2018", "text": "hi", "geo": null, "place": null, "user": {"id": 2, "created_at": null, "screen_name": "s", "name": "n", "location": null, "url": null, "description": null, "protected": false, "verified": false, "friends_count": 0, "listed_count": 0, "favourites_count": 0, "statuses_count": 1}, "entities": {"urls": [], "user_mentions": [], "hashtags": [], "symbols": []}}'])
+    >>> buffers['stg_tweets'].getvalue().split('\t')[:3]
+    ['1', '2', 'Wed Oct 10 20:19:24 +0000 2018']
+    '''
+    buffers = new_buffers()
+    for line in lines:
+        buffer_tweet(buffers,json_loads(line))
+    return buffers
 
-        try:
-            media = tweet['extended_tweet']['extended_entities']['media']
-        except KeyError:
-            try:
-                media = tweet['extended_entities']['media']
-            except KeyError:
-                media = []
-
-        for medium in media:
-            id_urls = get_id_urls(medium['media_url'], connection)
-            
-            sql=sqlalchemy.sql.text('''
-            INSERT INTO tweet_media
-            (id_tweets, id_urls, type)
-            VALUES
-            (:id_tweets,:id_urls,:type)
-            ON CONFLICT DO NOTHING
-            ''')
-            
-            res = connection.execute(sql,{
-                'id_tweets':tweet['id'],
-                'id_urls':id_urls,
-                'type':medium['type']
-                })
 
 ################################################################################
 # main functions
 ################################################################################
 
-if __name__ == '__main__':
-    
+def main():
+    '''
+    Load the tweets in the zip files given on the command line into the database.
+    All of the work happens here rather than at module level,
+    so importing this module (e.g. in the multiprocessing workers, or for doctests) has no side effects.
+    '''
     # process command line args
-    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--db',required=True)
     parser.add_argument('--inputs',nargs='+',required=True)
     parser.add_argument('--print_every',type=int,default=1000)
+    parser.add_argument('--method',choices=['copy','insert'],default='copy')
+    parser.add_argument('--batch_size',type=int,default=10000)
+    parser.add_argument('--processes',type=int,default=1,help=(
+        'number of worker processes that parse tweets (requires --method=copy); '
+        'with more than 1, tweets already in the database are not skipped before loading '
+        '(they are still ignored by ON CONFLICT DO NOTHING)'
+        ))
+    parser.add_argument('--drop_indexes',action='store_true')
     args = parser.parse_args()
+    if args.processes > 1 and args.method != 'copy':
+        parser.error('--processes > 1 requires --method=copy')
 
     # create database connection
+    #
+    # NOTE:
+    # the options below tune the session for bulk loading;
+    # synchronous_commit=off means commits do not wait for the WAL to be flushed to disk,
+    # so a crash of the database server can lose the most recently committed batches
+    # (but never corrupts the database);
+    # this is safe here because every insert uses ON CONFLICT DO NOTHING,
+    # so rerunning the script reloads any lost tweets;
+    # the larger work_mem lets the DISTINCT/JOINs in flush_buffers run in memory
     engine = sqlalchemy.create_engine(args.db, connect_args={
         'application_name': 'load_tweets.py',
+        'options': '-c synchronous_commit=off -c work_mem=256MB',
         })
     connection = engine.connect()
 
-    # loop through the input file
-    # NOTE:
-    # we reverse sort the filenames because this results in fewer updates to the users table,
-    # which prevents excessive dead tuples and autovacuums
-    for filename in sorted(args.inputs, reverse=True):
-        with zipfile.ZipFile(filename, 'r') as archive: 
-            print(datetime.datetime.now(),filename)
-            for subfilename in sorted(archive.namelist(), reverse=True):
-                with io.TextIOWrapper(archive.open(subfilename)) as f:
-                    for i,line in enumerate(f):
+    # with --drop_indexes, the indexes are dropped before loading and rebuilt afterwards
+    # (even if the load fails, so that the database is never left without its indexes)
+    indexdefs = drop_indexes(connection) if args.drop_indexes else []
+    try:
+        # the input lines are grouped into batches of --batch_size tweets;
+        # with a single process, each batch is parsed and loaded with load_batch;
+        # with --processes > 1, worker processes parse the batches and format the COPY rows,
+        # and this process only runs flush_buffers, so there is still just one db connection
+        batches = read_batches(args.inputs,args.batch_size,args.print_every)
+        if args.processes == 1:
+            for lines in batches:
+                load_batch(connection,[ json_loads(line) for line in lines ],args.method)
+        else:
+            with multiprocessing.Pool(args.processes) as pool:
 
-                        # load and insert the tweet
-                        tweet = json.loads(line)
-                        insert_tweet(connection,tweet)
+                # at most two batches per worker are in flight,
+                # so the input files are not read into memory faster than they can be loaded
+                pending = collections.deque()
+                for lines in batches:
+                    pending.append(pool.apply_async(buffer_lines,(lines,)))
+                    if len(pending) >= 2*args.processes:
+                        flush_buffers(connection,pending.popleft().get())
+                while pending:
+                    flush_buffers(connection,pending.popleft().get())
+    finally:
+        create_indexes(connection,indexdefs)
 
-                        # print message
-                        if i%args.print_every==0:
-                            print(datetime.datetime.now(),filename,subfilename,'i=',i,'id=',tweet['id'])
+
+if __name__ == '__main__':
+    main()
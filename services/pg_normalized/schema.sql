@@ -100,6 +100,77 @@ CREATE TABLE tweet_media (
     FOREIGN KEY (id_tweets) REFERENCES tweets(id_tweets)
 );
 
+/*
+ * Staging tables used by load_tweets.py to bulk load tweets with COPY.
+ * They mirror the tables above, except that urls are stored as text (instead of id_urls)
+ * and geo is stored as WKT text (instead of a geometry).
+ * The tables are UNLOGGED because their contents are truncated after every batch,
+ * so there is no need to write them to the WAL.
+ */
+CREATE UNLOGGED TABLE stg_urls (
+    url TEXT
+);
+
+CREATE UNLOGGED TABLE stg_users (
+    id_users BIGINT,
+    created_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ,
+    url TEXT,
+    friends_count INTEGER,
+    listed_count INTEGER,
+    favourites_count INTEGER,
+    statuses_count INTEGER,
+    protected BOOLEAN,
+    verified BOOLEAN,
+    screen_name TEXT,
+    name TEXT,
+    location TEXT,
+    description TEXT,
+    withheld_in_countries VARCHAR(2)[]
+);
+
+CREATE UNLOGGED TABLE stg_tweets (
+    id_tweets BIGINT,
+    id_users BIGINT,
+    created_at TIMESTAMPTZ,
+    in_reply_to_status_id BIGINT,
+    in_reply_to_user_id BIGINT,
+    quoted_status_id BIGINT,
+    retweet_count SMALLINT,
+    favorite_count SMALLINT,
+    quote_count SMALLINT,
+    withheld_copyright BOOLEAN,
+    withheld_in_countries VARCHAR(2)[],
+    source TEXT,
+    text TEXT,
+    country_code VARCHAR(2),
+    state_code VARCHAR(2),
+    lang TEXT,
+    place_name TEXT,
+    geo TEXT
+);
+
+CREATE UNLOGGED TABLE stg_tweet_urls (
+    id_tweets BIGINT,
+    url TEXT
+);
+
+CREATE UNLOGGED TABLE stg_tweet_mentions (
+    id_tweets BIGINT,
+    id_users BIGINT
+);
+
+CREATE UNLOGGED TABLE stg_tweet_tags (
+    id_tweets BIGINT,
+    tag TEXT
+);
+
+CREATE UNLOGGED TABLE stg_tweet_media (
+    id_tweets BIGINT,
+    url TEXT,
+    type TEXT
+);
+
 /*
  * Precomputes the total number of occurrences for each hashtag
  */